@@ -4,41 +4,136 @@ This module supports transparently caching iterator values to disk using the `ca
 or simply storing and loading to and from disk explicitly.
 
 You can simply write an expensive iterator, decorate it with `cached_iter` and it will be cached to disk.
+
+Files contain a sequence of frames, each a msgpack encoded value prefixed with its length
+as a 4 byte big endian unsigned integer.
 """
+import inspect
+import itertools
+import mmap
+import os
+import struct
 import tempfile
 import threading
-from collections import defaultdict
-from functools import wraps
-from hashlib import blake2b
+from collections import deque
+from contextlib import contextmanager
+from functools import lru_cache, wraps
+from hashlib import blake2s
 from pathlib import Path
-from typing import Any, Callable, Iterable, Iterator, Optional, TypeVar, Union
-
-import msgpack
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    Optional,
+    Set,
+    TypeVar,
+    Union,
+)
+from weakref import WeakValueDictionary
+
+import msgspec
 
 T = TypeVar("T")  # Iterator element type
 
-_CACHE_LOCKS = defaultdict(threading.Lock)
+_ENCODER = msgspec.msgpack.Encoder()
+_DECODER = msgspec.msgpack.Decoder()
+# Sorts dictionary keys, so the digest does not depend on keyword argument order
+_DIGEST_ENCODER = msgspec.msgpack.Encoder(order="deterministic")
+_WRITE_BUFFER_SIZE = 64 * 1024
+# Compiled once, the header is packed and unpacked for every value
+_FRAME_HEADER = struct.Struct(">I")
+_FRAME_HEADER_SIZE = _FRAME_HEADER.size
+_LOCATION_CACHE_SIZE = 128
+# Argument types whose equal values of the same type always encode, and so hash, the same.
+# Not float: 0.0 == -0.0, but they encode differently.
+_MEMOIZED_ARGUMENT_TYPES = frozenset({str, int, bool, bytes, type(None)})
+
+
+class _ReadWriteLock:
+    """Lock that is either held by any number of readers or by a single writer"""
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = 0
+        self._writing = False
+
+    @contextmanager
+    def reading(self) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: not self._writing)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._condition.notify_all()
+
+    @contextmanager
+    def writing(self) -> Iterator[None]:
+        with self._condition:
+            self._condition.wait_for(lambda: not (self._writing or self._readers))
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._condition:
+                self._writing = False
+                self._condition.notify_all()
+
+
+# Locks are only kept alive while they are used, so the mapping does not grow with every location used
+_CACHE_LOCKS: "WeakValueDictionary[Path, _ReadWriteLock]" = WeakValueDictionary()
+_CACHE_LOCKS_LOCK = threading.Lock()
+
+
+def _cache_lock(location: Path) -> _ReadWriteLock:
+    with _CACHE_LOCKS_LOCK:
+        lock = _CACHE_LOCKS.get(location)
+        if lock is None:
+            lock = _CACHE_LOCKS[location] = _ReadWriteLock()
+        return lock
+
+
+def _encodable(value: Any) -> bool:
+    """Whether value is hashed using msgpack, so the same across runs, see `_digest_input`"""
+    try:
+        _DIGEST_ENCODER.encode(value)
+    except (TypeError, OverflowError, msgspec.EncodeError):
+        return False
+    return True
+
+
+def _digest_input(args: tuple, kwargs: dict) -> bytes:
+    """Bytes to hash for the arguments, msgpack if they can be encoded and their `repr` otherwise"""
+    try:
+        return _DIGEST_ENCODER.encode((args, kwargs))
+    except (TypeError, OverflowError, msgspec.EncodeError):
+        return (repr(args) + "#" + repr(kwargs)).encode("utf-8")
 
 
 def short_digester(digest_size: int = 8) -> str:
     """Return a short stable hash for the given string value.
 
-    A shorthand for de default is `short_digest`
+    A shorthand for de default is `short_digest`. The `digest_size` is in bytes and at most 32.
 
     # Examples
     >>> short_digester()("hello")
-    '922c57d1cceebf8d'
+    '59a042f7abbf1cb2'
     >>> short_digester(digest_size=10)("hello")
-    '7adb7bb284a089b81d73'
+    '730898e0c01501c1295f'
     >>> short_digest("hello")
-    '922c57d1cceebf8d'
+    '59a042f7abbf1cb2'
+    >>> short_digest(object) == short_digest(object)
+    True
     """
 
     def _digest(*args, **kwargs) -> str:
         nonlocal digest_size
-        return blake2b(
-            (repr(args) + "#" + repr(kwargs)).encode("utf-8"), digest_size=digest_size
-        ).hexdigest()
+        return blake2s(_digest_input(args, kwargs), digest_size=digest_size).hexdigest()
 
     return _digest
 
@@ -48,9 +143,13 @@ short_digest: Callable[..., str] = short_digester()
 
 This method is the default digester returned by `short_digester`.
 
-All position and keyword arguments are hashed using `blake2b` into a small hexadecimal string.
-The implementation is not fast and uses `repr` to stringify the values, so this might not even
-be stable across runs for complex objects where `repr` only sees an object type and memory address.
+All position and keyword arguments are hashed using `blake2s` into a small hexadecimal string.
+The arguments are encoded using msgpack, which is stable for simple values like numbers, strings,
+lists and dictionaries. Note that tuples and lists encode, and so hash, the same.
+Dictionary keys, like keyword argument names, are sorted so their order does not change the hash.
+Values msgpack can not encode, including dictionaries with non-string keys, fall back to using
+`repr` to stringify all the arguments, so this might not even be stable across runs for complex
+objects where `repr` only sees an object type and memory address.
 """
 
 
@@ -62,7 +161,10 @@ def cached_iter(
 
     The default behavior is to store the iterator values in a temporary file, that is **not** deleted after the program exits.
     The name of this file is based on the name of the function and its location in the source code and iterator arguments,
-    using `short_digest` to avoid filesystem path length limits.
+    using a `short_digest` style hash to avoid filesystem path length limits.
+    The arguments are bound to the signature of the iterator with defaults applied before hashing, so equivalent calls
+    like `f(1)`, `f(1, b=2)` and `f(a=1)` for `def f(a, b=2)` share the cache file.
+    Defaults msgpack can not encode, like functions, are left out, so they do not change the hash between runs.
 
 
 
@@ -70,12 +172,18 @@ def cached_iter(
         get_storage_location (Callable[[str, list, dict], Path], optional):
             Used to determine the location of the cache file.
             Will receive iterator method name, arguments and keyword arguments. Is expected to return a `pathlib.Path` where the cache is stored.
+            The location is remembered for recent calls with only `str`, `int`, `bool`, `bytes` or `None` arguments,
+            so it should only depend on the values it receives. This keeps the arguments of up to 128 calls alive.
             Defaults to `None`.
         base_path (Union[Path, str], optional):
             Base path of automatically generated cache files.
             If `None`, the system default temporary storage location is used.
             Defaults to `None`.
 
+    Cache files that are known to exist are not checked on the filesystem again,
+    use `cache_clear` on the decorated function to remove them. Cache files removed by
+    other means are written again when they turn out to be missing.
+
     Returns:
         decorator for an iterator.
 
@@ -99,31 +207,109 @@ def cached_iter(
     elif isinstance(base_path, str):
         base_path = Path(base_path)
 
+    # Only the default location hashes the arguments bound to the iterator signature
+    bind_arguments = get_storage_location is None
     if get_storage_location is None:
+        method_hashers: Dict[str, Any] = {}
 
         def get_storage_location(method_name, args, kwds) -> Path:
             nonlocal base_path
-            return (
-                base_path / f"dqp_{short_digest(method_name, *args, **kwds)}.msgpacks"
-            )
+            hasher = method_hashers.get(method_name)
+            if hasher is None:
+                # Hash the method name once, every call continues from a copy
+                hasher = method_hashers[method_name] = blake2s(
+                    method_name.encode("utf-8") + b"#", digest_size=8
+                )
+            hasher = hasher.copy()
+            hasher.update(_digest_input(args, kwds))
+            return base_path / f"dqp_{hasher.hexdigest()}.frames"
 
     def _decorator(
         user_function: Callable[..., Iterator[T]]
     ) -> Callable[..., Iterator[T]]:
         method_name = f"{user_function.__module__}.{user_function.__qualname__}"
+        try:
+            signature = inspect.signature(user_function)
+        except (TypeError, ValueError):
+            signature = None  # Some builtins have no signature to bind to
+        # Defaults like functions would be hashed by their `repr`, which differs between runs
+        digest_defaults: Dict[str, Any] = {}
+        if bind_arguments and signature is not None:
+            digest_defaults = {
+                name: parameter.default
+                for name, parameter in signature.parameters.items()
+                if parameter.default is not parameter.empty
+                and _encodable(parameter.default)
+            }
+
+        def _location(args: tuple, kwds: dict) -> Path:
+            nonlocal get_storage_location, method_name
+            if bind_arguments and signature is not None:
+                try:
+                    bound = signature.bind(*args, **kwds)
+                except TypeError:
+                    pass  # Invalid arguments, calling the iterator will raise
+                else:
+                    for name, default in digest_defaults.items():
+                        bound.arguments.setdefault(name, default)
+                    args, kwds = bound.args, bound.kwargs
+            return get_storage_location(method_name, args, kwds)
+
+        @lru_cache(maxsize=_LOCATION_CACHE_SIZE, typed=True)
+        def _cached_location(*args, **kwds) -> Path:
+            return _location(args, kwds)
+
+        # Locations known to hold a cache file, to avoid a stat call on every call
+        existing_locations: Set[Path] = set()
+
+        def _tee(iterator: Iterator[T], location: Path) -> Iterator[T]:
+            try:
+                yield from tee(iterator, location)
+            except BaseException:
+                existing_locations.discard(location)
+                raise
+            _remember_location(location)
+
+        def _replay(location: Path, args: tuple, kwds: dict) -> Iterator[T]:
+            values = scan(location)
+            try:
+                value = next(values)  # Opens the cache file
+            except StopIteration:
+                return
+            except FileNotFoundError:
+                # Removed outside of this process, like by a temporary files cleaner
+                existing_locations.discard(location)
+                yield from _tee(user_function(*args, **kwds), location)
+                return
+            yield value
+            yield from values
+
+        def _remember_location(location: Path) -> None:
+            if len(existing_locations) >= _LOCATION_CACHE_SIZE:
+                existing_locations.clear()
+            existing_locations.add(location)
 
         @wraps(user_function)
         def _wrapper(*args, **kwds) -> Iterator[T]:
-            nonlocal method_name, get_storage_location
-            location = get_storage_location(method_name, args, kwds)
-            if not location.exists():
-                return tee(user_function(*args, **kwds), location)
+            # Only scalars, lru_cache treats equal containers like (1, 2) and (1.0, 2.0) as the same key
+            if all(type(arg) in _MEMOIZED_ARGUMENT_TYPES for arg in args) and all(
+                type(arg) in _MEMOIZED_ARGUMENT_TYPES for arg in kwds.values()
+            ):
+                location = _cached_location(*args, **kwds)
             else:
-                return scan(location)
+                location = _location(args, kwds)
+            if location in existing_locations:
+                return _replay(location, args, kwds)
+            elif location.exists():
+                _remember_location(location)
+                return _replay(location, args, kwds)
+            else:
+                return _tee(user_function(*args, **kwds), location)
 
         def cache_clear(*args, **kwds):
-            nonlocal get_storage_location, method_name
-            get_storage_location(method_name, args, kwds).unlink(missing_ok=True)
+            location = _location(args, kwds)
+            existing_locations.discard(location)
+            location.unlink(missing_ok=True)
 
         _wrapper.cache_clear = cache_clear
 
@@ -132,6 +318,22 @@ def cached_iter(
     return _decorator
 
 
+def _append_frame(buffer: bytearray, obj: Any) -> None:
+    """Append obj to the buffer as a frame, msgpack encoded and prefixed with its length
+
+    If obj can not be encoded, the buffer is left as it was.
+    """
+    start = len(buffer)
+    buffer.extend(bytes(_FRAME_HEADER_SIZE))
+    try:
+        _ENCODER.encode_into(obj, buffer, -1)
+    except BaseException:
+        # Drop the header and any partially encoded value
+        del buffer[start:]
+        raise
+    _FRAME_HEADER.pack_into(buffer, start, len(buffer) - start - _FRAME_HEADER_SIZE)
+
+
 def save(location: Union[Path, str], obj: T, append: bool = False) -> None:
     """Save object to disk at location
 
@@ -149,15 +351,17 @@ def save(location: Union[Path, str], obj: T, append: bool = False) -> None:
         raise ValueError(
             "msgpack does not support tuples, they would be read back as lists"
         )
-    global _CACHE_LOCKS
-    with _CACHE_LOCKS[location]:
-        packer = msgpack.Packer()
-        if append:
-            with location.open("ab") as disk_cache:
-                disk_cache.write(packer.pack(obj))
-        else:
-            with location.open("wb") as disk_cache:
-                disk_cache.write(packer.pack(obj))
+    frame = bytearray()
+    _append_frame(frame, obj)
+    with _cache_lock(location).writing():
+        with location.open("ab" if append else "wb") as disk_cache:
+            disk_cache.write(frame)
+
+
+def _advise_sequential(fd: int) -> None:
+    """Have the kernel read ahead more aggressively, where supported, the file is read front to back"""
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
 
 
 def load(location: Union[Path, str]) -> Optional[Any]:
@@ -171,14 +375,19 @@ def load(location: Union[Path, str]) -> Optional[Any]:
     """
     if isinstance(location, str):
         location = Path(location)
-    global _CACHE_LOCKS
-    with _CACHE_LOCKS[location]:
+    with _cache_lock(location).reading():
         try:
             with location.open("rb") as disk_cache:
-                for value in msgpack.Unpacker(disk_cache):
-                    return value
+                _advise_sequential(disk_cache.fileno())
+                # Only the first frame is read, files appended to hold more objects
+                header = disk_cache.read(_FRAME_HEADER_SIZE)
+                if len(header) < _FRAME_HEADER_SIZE:
+                    return None
+                (size,) = _FRAME_HEADER.unpack(header)
+                payload = disk_cache.read(size)
         except FileNotFoundError:
             return None
+    return _DECODER.decode(payload)
 
 
 def tee(iterable: Iterator[T], location: Union[Path, str]) -> Iterator[T]:
@@ -194,34 +403,103 @@ def tee(iterable: Iterator[T], location: Union[Path, str]) -> Iterator[T]:
     Raises:
         ValueError: If the value in the iterator is a tuple (msgpack does not support tuples).
     """
-    global _CACHE_LOCKS
     if isinstance(location, str):
         location = Path(location)
-    with _CACHE_LOCKS[location]:
-        packer = msgpack.Packer()
+    with _cache_lock(location).writing():
+        buffer = bytearray()
         try:
             with location.open("wb") as disk_cache:
-                for value in iterable:
-                    if isinstance(value, tuple):
-                        raise ValueError(
-                            "msgpack does not support tuples, they would be read back as lists"
-                        )
-                    disk_cache.write(packer.pack(value))
-                    yield value
+                try:
+                    for value in iterable:
+                        if isinstance(value, tuple):
+                            raise ValueError(
+                                "msgpack does not support tuples, they would be read back as lists"
+                            )
+                        _append_frame(buffer, value)
+                        if len(buffer) >= _WRITE_BUFFER_SIZE:
+                            disk_cache.write(buffer)
+                            buffer.clear()
+                        yield value
+                finally:
+                    disk_cache.write(buffer)
         except Exception as e:
             location.unlink(missing_ok=True)
             raise e
 
 
-def scan(location: Path) -> Iterator[T]:
-    """Load iterator from file on disk at location"""
-    global _CACHE_LOCKS
+@contextmanager
+def _mapped(location: Path) -> Iterator[memoryview]:
+    """Read only view of the contents of the file at location, while holding its read lock"""
+    with _cache_lock(location).reading(), location.open("rb") as disk_cache:
+        if os.fstat(disk_cache.fileno()).st_size == 0:
+            # Empty files can not be mapped
+            yield memoryview(b"")
+            return
+        _advise_sequential(disk_cache.fileno())
+        with mmap.mmap(
+            disk_cache.fileno(), 0, access=mmap.ACCESS_READ
+        ) as mapped, memoryview(mapped) as view:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                # Page faults on the mapping read ahead as well
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            yield view
+
+
+def _decode_frames(
+    location: Path,
+    decode: Callable[[memoryview], T],
+    skip: int = 0,
+    offset: int = 0,
+    finished: bool = False,
+) -> Iterator[T]:
+    """Decode the payload of every complete frame in the file at location, starting at byte offset
+
+    The first `skip` frames are stepped over using their length only, without decoding them.
+    An incomplete frame at the end is taken to be still being written, unless the file is known to be `finished`:
+    then it raises a `ValueError`, as does a file in the format before length prefixed frames.
+    """
+    with _mapped(location) as view:
+        end = len(view)
+        while offset + _FRAME_HEADER_SIZE <= end:
+            (size,) = _FRAME_HEADER.unpack_from(view, offset)
+            if offset + _FRAME_HEADER_SIZE + size > end:
+                break  # Truncated, the last frame is still being written
+            offset += _FRAME_HEADER_SIZE
+            if skip:
+                skip -= 1
+            else:
+                # Decode directly from the page cache, no slice may outlive the mapping
+                yield decode(view[offset : offset + size])
+            offset += size
+        if finished and offset != end:
+            raise ValueError(
+                f"Frame at byte {offset} of '{location}' runs past the end of the file, "
+                "the file is corrupt or was written before values were stored as length prefixed frames"
+            )
+
+
+def scan(location: Path, skip: int = 0, offset: int = 0) -> Iterator[T]:
+    """Load iterator from file on disk at location, optionally skipping the first `skip` values without decoding them
+
+    Reading starts at byte `offset`, which must be the start of a value in the file.
+    """
+    if isinstance(location, str):
+        location = Path(location)
+    return _decode_frames(location, _DECODER.decode, skip, offset)
+
+
+def scan_raw(location: Union[Path, str], skip: int = 0) -> Iterator[msgspec.Raw]:
+    """Load the encoded values from file on disk at location, without decoding them
+
+    The values are returned as `msgspec.Raw`, which `save`, `tee` and `dqp.disk_queue.Sink.write_dict`
+    write as is. Use this to forward values to another file without decoding and encoding them again.
+    The first `skip` values are left out.
+    """
     if isinstance(location, str):
         location = Path(location)
-    with _CACHE_LOCKS[location]:
-        with location.open("rb") as disk_cache:
-            for value in msgpack.Unpacker(disk_cache):
-                yield value
+    return _decode_frames(
+        location, lambda payload: msgspec.Raw(payload.tobytes()), skip
+    )
 
 
 def first(iterator: Optional[Union[Iterator[T], Iterable[T]]]) -> Optional[T]:
@@ -241,7 +519,7 @@ def count_iter(iterator: Optional[Union[Iterator[T], Iterable[T]]]) -> int:
     """
     if iterator is None:
         return 0
-    elif isinstance(iterator, Iterator):
-        return sum(1 for _ in iterator)
-    else:
-        return sum(1 for _ in iter(iterator))
+    counter = itertools.count()
+    # Consume in C, zip only advances the counter for elements of the iterator
+    deque(zip(iterator, counter), maxlen=0)
+    return next(counter)
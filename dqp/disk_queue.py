@@ -4,6 +4,9 @@
 Module to do simple disk based processing of messagepack dictionaries in a file. 
 
 All files are flat files and directories. To manage a simple folder structure with naming convention, use the `dqp.disk_queue.Project` class.
+Queue files contain length prefixed msgpack frames, the same file format `dqp.disk_cache` uses.
+Next to each queue file, an index file with the `.idx` suffix holds the byte offset of every message
+as a little endian 64 bit unsigned integer, which allows the source to continue from a message without reading the ones before it.
 
 From the project you can open a source/sink and read/write with them using python dictionaries.
 
@@ -38,52 +41,175 @@ Clean up by telling the source to unlink everything up to last or a given queue
 
 
 """
-import itertools
 import os
+import shutil
+import struct
 import time
+from bisect import bisect_left
 from datetime import datetime, timezone
 from hashlib import blake2s
+from pathlib import Path
 from typing import Callable, Iterator, Optional, Tuple
 
-import msgpack
+import msgspec
 
+from dqp.disk_cache import _append_frame, _decode_frames, count_iter
 from dqp.storage import Folder
 
 QUEUE_FILE_HASH_SEPARATOR = "_"
+QUEUE_INDEX_SUFFIX = ".idx"
+
+_WRITE_BUFFER_SIZE = 64 * 1024
+_INDEX_ENTRY = struct.Struct("<Q")
+_INDEX_ENTRY_SIZE = _INDEX_ENTRY.size
+# Shared by all sources, queues only hold dictionaries
+_MESSAGE_DECODER = msgspec.msgpack.Decoder(dict)
+
+
+def _sorted_files(
+    path: str, relative_path: str = "", start: Optional[str] = None
+) -> Iterator[str]:
+    """Yield the paths relative to path of all queue files below it, sorted by path
+
+    Directories are sorted as their name with a trailing separator,
+    which results in the same order as sorting all the relative paths.
+    Like `os.walk`, symbolic links to directories are not followed.
+    Index files and hidden entries, with a name starting with a dot, are left out while listing.
+
+    If start is given, paths sorting before it are skipped without walking
+    the directories that only contain such paths.
+    """
+    entries = []
+    with os.scandir(path) as directory:
+        for entry in directory:
+            name = entry.name
+            if name.startswith("."):
+                continue
+            if not entry.is_dir():
+                if not name.endswith(QUEUE_INDEX_SUFFIX):
+                    entries.append((name, name, False))
+            elif not entry.is_symlink():
+                entries.append((name + os.sep, name, True))
+    entries.sort()
+    for sort_key, name, is_dir in entries:
+        path_key = relative_path + sort_key
+        if start is not None:
+            if path_key < start and not (is_dir and start.startswith(path_key)):
+                continue
+        if is_dir:
+            yield from _sorted_files(os.path.join(path, name), path_key, start)
+        else:
+            yield path_key
+        # Everything after this entry sorts after start
+        start = None
+
+
+def _will_need(path: str) -> None:
+    """Hint the kernel to start reading the file at path, where supported"""
+    if not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+    finally:
+        os.close(fd)
+
+
+def _indexed_position(path: str, idx: int) -> Tuple[int, int]:
+    """Byte offset of a message at or before index idx in the queue file at path and the number of messages left to skip from there
+
+    Queue files without an index file, or with an index that is not complete yet, are read from the last known message.
+    """
+    if idx <= 0:
+        return 0, 0
+    try:
+        with open(path + QUEUE_INDEX_SUFFIX, "rb") as index_file:
+            entries = os.fstat(index_file.fileno()).st_size // _INDEX_ENTRY_SIZE
+            if entries == 0:
+                return 0, idx
+            entry = min(idx, entries - 1)
+            index_file.seek(entry * _INDEX_ENTRY_SIZE)
+            (offset,) = _INDEX_ENTRY.unpack(index_file.read(_INDEX_ENTRY_SIZE))
+    except FileNotFoundError:
+        return 0, idx
+    return offset, idx - entry
+
+
+def _is_finished(queue_filename: str) -> bool:
+    """Whether the sink closed the queue file, renaming it with the hash of its contents"""
+    return QUEUE_FILE_HASH_SEPARATOR in os.path.basename(queue_filename)
+
+
+def _open_append(path: str) -> int:
+    """Open a new file at path for appending, returning its file descriptor
+
+    Python marks the descriptor as non-inheritable, the equivalent of `O_CLOEXEC`.
+    """
+    return os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o666)
+
+
+def _write_all(fd: int, data: memoryview) -> None:
+    """Write all of data to the file descriptor"""
+    written = 0
+    while written < len(data):
+        written += os.write(fd, data[written:])
+
+
+def _unlink_missing_ok(path: str) -> None:
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
 
 
 class Sink:
-    """Queue sink"""
+    """Queue sink
+
+    Messages are buffered in memory and written to the queue file in batches,
+    the buffer is written out when it holds at least `write_buffer_size` bytes, on `flush` and on rotate/close.
+    """
 
-    def __init__(self, base_path: str, head_timeout_seconds: int = 600):
+    def __init__(
+        self,
+        base_path: str,
+        head_timeout_seconds: int = 600,
+        write_buffer_size: int = _WRITE_BUFFER_SIZE,
+    ):
         self.base_path = base_path
         self.head_timeout_seconds = head_timeout_seconds
+        self.write_buffer_size = write_buffer_size
         self.open(datetime.now(timezone.utc))
 
     def open(self, now: datetime) -> None:
         now_path = self.now_path(now)
         self.last_open_time = now
+        self.rotate_deadline = time.monotonic() + self.head_timeout_seconds
         os.makedirs(os.path.dirname(now_path), exist_ok=True)
         assert not os.path.exists(now_path), "Detached files are considered immutable"
-        self.output_file = open(
-            now_path,
-            "wb",
-        )
-        self.packer = msgpack.Packer()
+        # Without a Python file object, output_buffer already batches the messages
+        self.output_fd = _open_append(now_path)
+        self.index_fd = _open_append(now_path + QUEUE_INDEX_SUFFIX)
         self.output_path = now_path
         self.output_index = 0
+        self.output_size = 0
         self.output_hash = blake2s()
+        self.output_buffer = bytearray()
+        self.index_buffer = bytearray()
 
     def write_dict(self, dictionary_value: dict):
-        msg = self.packer.pack(dictionary_value)
-        self.output_file.write(msg)
-        self.output_file.flush()
+        offset = self.output_size + len(self.output_buffer)
+        _append_frame(self.output_buffer, dictionary_value)
+        # Only index messages that were encoded
+        self.index_buffer += _INDEX_ENTRY.pack(offset)
         self.output_index += 1
-        self.output_hash.update(msg)
-        now = time.time()
+        if len(self.output_buffer) >= self.write_buffer_size:
+            self.flush()
 
         # Time based rotation
-        if self.last_open_time.timestamp() + self.head_timeout_seconds < now:
+        if time.monotonic() > self.rotate_deadline:
             self.rotate()
 
     def now_path(self, now: datetime = datetime.now(timezone.utc)) -> str:
@@ -96,19 +222,45 @@ class Sink:
         self.close()
         self.open(datetime.now(timezone.utc))
 
+    def flush(self):
+        """Write the buffered messages to the queue file with a single write call
+
+        The frames are appended to one contiguous buffer, so no gather write is needed.
+        The index is written after the messages, so it never points past the end of the queue file.
+        """
+        with memoryview(self.output_buffer) as pending:
+            self.output_hash.update(pending)
+            _write_all(self.output_fd, pending)
+            self.output_size += len(pending)
+        self.output_buffer.clear()
+        with memoryview(self.index_buffer) as pending:
+            _write_all(self.index_fd, pending)
+        self.index_buffer.clear()
+
     def close(self):
-        self.output_file.close()
+        """Write out the buffered messages and finalize the queue file, closing again does nothing"""
+        if self.output_fd < 0:
+            return
+        self.flush()
+        os.close(self.output_fd)
+        os.close(self.index_fd)
+        # The descriptor numbers may be reused by other files once closed
+        self.output_fd = self.index_fd = -1
         if self.output_index > 0:
             # finalize file, rename with .hash at the end.
-            os.rename(
-                self.output_path,
+            final_path = (
                 self.output_path
                 + QUEUE_FILE_HASH_SEPARATOR
-                + self.output_hash.hexdigest(),
+                + self.output_hash.hexdigest()
+            )
+            os.rename(self.output_path, final_path)
+            os.rename(
+                self.output_path + QUEUE_INDEX_SUFFIX, final_path + QUEUE_INDEX_SUFFIX
             )
         else:
             # Drop empty files
             os.unlink(self.output_path)
+            os.unlink(self.output_path + QUEUE_INDEX_SUFFIX)
 
     def __enter__(self):
         return self
@@ -131,12 +283,49 @@ class Source:
         if not os.path.exists(self.input_path):
             raise ValueError(f"Source path does not exist: '{self.input_path}'")
         self.starting_from = starting_from
-        self.last = None  # type: Optional[Tuple[str, int]]
+        # Position of the last read message, kept apart to avoid a tuple per message
+        self.last_filename = None  # type: Optional[str]
+        self.last_idx = 0
+
+    @property
+    def last(self) -> Optional[Tuple[str, int]]:
+        """Queue filename and index of the last message read, if any"""
+        if self.last_filename is None:
+            return None
+        return self.last_filename, self.last_idx
+
+    @last.setter
+    def last(self, value: Optional[Tuple[str, int]]) -> None:
+        if value is None:
+            self.last_filename, self.last_idx = None, 0
+        else:
+            self.last_filename, self.last_idx = value
 
     def all_dict(self) -> Iterator[Tuple[str, int, dict]]:
         """iterator for all of the elements in the queue (ignoring starting_from if given)"""
-        return itertools.chain.from_iterable(
-            map(self.dicts_from, self.queue_filenames())
+        for queue_filename in self._prefetching(self.queue_filenames()):
+            yield from self.dicts_from(queue_filename)
+
+    def all_msgs(self) -> Iterator[dict]:
+        """iterator for the messages in the queue without their position (ignoring starting_from if given)
+
+        Use `all_dict` or iterate the source itself when the queue filename and index of each message is needed.
+        """
+        for queue_filename in self._prefetching(self.queue_filenames()):
+            for idx, msg in enumerate(self._messages(queue_filename)):
+                self.last_filename = queue_filename
+                self.last_idx = idx
+                yield msg
+
+    def count(self) -> int:
+        """Number of messages in the queue (ignoring starting_from if given), without decoding them
+
+        Finished queue files are counted using the size of their index file,
+        the others by stepping over their messages.
+        """
+        return sum(
+            self._count_messages(queue_filename)
+            for queue_filename in self.queue_filenames()
         )
 
     def __iter__(self):
@@ -149,15 +338,22 @@ class Source:
     ) -> Iterator[Tuple[str, int, dict]]:
         """
         Start from a given position in the queues and continue
+
+        The index is the position within the first queue file with the given prefix,
+        the queue files after it are read from the start.
         """
-        queue_iter = itertools.dropwhile(
-            lambda fname: not fname.startswith(queue_filename_prefix),
-            self.queue_filenames(),
-        )
-        return itertools.dropwhile(
-            lambda el: el[1] < idx,
-            itertools.chain.from_iterable(map(self.dicts_from, queue_iter)),
+        queue_filenames = self._prefetching(
+            self.queue_filenames(start=queue_filename_prefix)
         )
+        # Sorted, so if the first filename does not have the prefix, none of them have
+        first_filename = next(queue_filenames, None)
+        if first_filename is None or not first_filename.startswith(
+            queue_filename_prefix
+        ):
+            return
+        yield from self.dicts_from(first_filename, idx)
+        for queue_filename in queue_filenames:
+            yield from self.dicts_from(queue_filename)
 
     def unlink_to(self, queue_filename_prefix: Optional[str] = None) -> int:
         """Unlink queue files up to (not including) the given file name prefix or self.last if queue_filename_prefix is None.
@@ -168,48 +364,83 @@ class Source:
         Returns the number of unlinked files
 
         """
-        unlink_count = 0
         if queue_filename_prefix is None and self.last is not None:
             queue_filename_prefix = self.last[0]
         if queue_filename_prefix is None:
-            return unlink_count
-
-        found = next(
-            (
-                queue_filename
-                for queue_filename in self.queue_filenames()
-                if queue_filename.startswith(queue_filename_prefix)
-            ),
-            None,
-        )
-        if found is None:
+            return 0
+
+        queue_filenames = list(self.queue_filenames())
+        # Sorted, so the first filename with the prefix is the first one not sorting before it
+        unlink_count = bisect_left(queue_filenames, queue_filename_prefix)
+        following = queue_filenames[unlink_count : unlink_count + 1]
+        if not (following and following[0].startswith(queue_filename_prefix)):
             raise ValueError(
                 f"Queue filename prefix '{queue_filename_prefix}' was not found in the queue filenames"
             )
-        for queue_filename in self.queue_filenames():
-            if queue_filename.startswith(queue_filename_prefix):
-                break
+        for queue_filename in queue_filenames[:unlink_count]:
             abs_path = os.path.join(self.input_path, queue_filename)
             os.unlink(abs_path)
-            unlink_count += 1
+            _unlink_missing_ok(abs_path + QUEUE_INDEX_SUFFIX)
         return unlink_count
 
-    def queue_filenames(self) -> Iterator[str]:
-        input_path_len = len(self.input_path) + 1  # path + slash character
-        for root, dirnames, filenames in os.walk(self.input_path):
-            dirnames.sort()
-            filenames.sort()
-            for filename in filenames:
-                yield os.path.join(root, filename)[input_path_len:]
+    def _prefetching(self, queue_filenames: Iterator[str]) -> Iterator[str]:
+        """Pass through queue filenames, letting the kernel read the next file while the current one is used"""
+        current = next(queue_filenames, None)
+        for following in queue_filenames:
+            _will_need(os.path.join(self.input_path, following))
+            yield current
+            current = following
+        if current is not None:
+            yield current
+
+    def queue_filenames(self, start: Optional[str] = None) -> Iterator[str]:
+        """Sorted queue filenames, relative to the input path
 
-    def dicts_from(self, filename: str) -> Iterator[Tuple[str, int, dict]]:
+        If start is given, only filenames that do not sort before start are returned.
+        """
+        return _sorted_files(self.input_path, start=start)
+
+    def dicts_from(
+        self, filename: str, idx: int = 0
+    ) -> Iterator[Tuple[str, int, dict]]:
+        """Messages in the given queue file, starting at index idx
+
+        Messages before idx are skipped without decoding them, using the index file where possible.
+        A negative idx starts at the first message.
+        """
+        idx = max(idx, 0)
+        offset, skip = _indexed_position(os.path.join(self.input_path, filename), idx)
+        for idx, msg in enumerate(self._messages(filename, skip, offset), idx):
+            self.last_filename = filename
+            self.last_idx = idx
+            yield filename, idx, msg
+
+    def _count_messages(self, filename: str) -> int:
         abs_path = os.path.join(self.input_path, filename)
-        with open(abs_path, "rb") as queue_file:
-            idx = 0
-            for msg in msgpack.Unpacker(queue_file):
-                self.last = filename, idx
-                yield filename, idx, msg
-                idx = idx + 1
+        # The index is only known to be complete once the sink renamed it with the hash
+        finished = _is_finished(filename)
+        if finished:
+            try:
+                return (
+                    os.stat(abs_path + QUEUE_INDEX_SUFFIX).st_size // _INDEX_ENTRY_SIZE
+                )
+            except FileNotFoundError:
+                pass
+        return count_iter(
+            _decode_frames(Path(abs_path), lambda payload: None, finished=finished)
+        )
+
+    def _messages(
+        self, filename: str, skip: int = 0, offset: int = 0
+    ) -> Iterator[dict]:
+        """Decode the messages in the given queue file, see `dqp.disk_cache.scan`"""
+        return _decode_frames(
+            Path(self.input_path, filename),
+            _MESSAGE_DECODER.decode,
+            skip,
+            offset,
+            finished=_is_finished(filename),
+        )
 
 
 class Project:
@@ -257,6 +488,15 @@ class Project:
             )
         return self.open_source(name, starting_from)
 
+    def copy_to(self, target_path: str) -> None:
+        """Copy the project folder to target_path, which must not exist yet
+
+        Only what is on disk is copied: messages still buffered in open sinks and vars
+        that are only written on close are not, so copy a project after closing it to get everything.
+        On Linux the files are copied within the kernel using `os.sendfile`.
+        """
+        shutil.copytree(self.storage_folder.path, target_path, symlinks=True)
+
     def state_folder(self, name: str) -> Folder:
         folder = Folder(self.storage_folder.child(f"state/{name}"))
         self.closeables.append(folder.close)
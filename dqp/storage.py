@@ -1,9 +1,58 @@
 import os
 
-import msgpack
+import msgspec
 
 VARS_FILENAME = "vars.msgpack"
 
+_ENCODER = msgspec.msgpack.Encoder()
+_DECODER = msgspec.msgpack.Decoder(dict)
+_MISSING = object()
+
+
+class _DirtyDict(dict):
+    """Dictionary that keeps track of whether it was modified
+
+    Setting an item to the value it already has does not count as a modification.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.dirty = False
+
+    def __setitem__(self, key, value):
+        if not self.dirty:
+            current = self.get(key, _MISSING)
+            self.dirty = type(current) is not type(value) or current != value
+        super().__setitem__(key, value)
+
+    def __delitem__(self, key):
+        self.dirty = True
+        super().__delitem__(key)
+
+    def __ior__(self, other):
+        self.dirty = True
+        return super().__ior__(other)
+
+    def clear(self):
+        self.dirty = True
+        super().clear()
+
+    def pop(self, *args):
+        self.dirty = True
+        return super().pop(*args)
+
+    def popitem(self):
+        self.dirty = True
+        return super().popitem()
+
+    def setdefault(self, key, default=None):
+        self.dirty = True
+        return super().setdefault(key, default)
+
+    def update(self, *args, **kwargs):
+        self.dirty = True
+        super().update(*args, **kwargs)
+
 
 class Folder:
     """
@@ -21,12 +70,12 @@ class Folder:
     def open(self) -> None:
         self.create_path("")
         vars_filename = os.path.join(self.path, VARS_FILENAME)
-        self.vars = {}  # type: Dict[str, str]
+        self.vars = _DirtyDict()  # type: Dict[str, str]
         self.read_vars_contents = b""
         if os.path.exists(vars_filename):
             with open(vars_filename, "rb") as vars_file:
                 self.read_vars_contents = vars_file.read()
-                self.vars = msgpack.loads(self.read_vars_contents)
+                self.vars = _DirtyDict(_DECODER.decode(self.read_vars_contents))
 
     def __enter__(self):
         return self
@@ -45,10 +94,24 @@ class Folder:
     def close(self) -> None:
         """
         Close the folder, this will flush the vars to disk
+
+        The vars are written to a temporary file first, synced to disk and then moved in place,
+        so the vars file is never left partially written, not even after a crash.
         """
+        tracked = isinstance(self.vars, _DirtyDict)
+        if tracked and not self.vars.dirty:
+            return
         vars_path = self.child(VARS_FILENAME)
         if len(self.vars) or os.path.exists(vars_path):
-            vars_content = msgpack.dumps(self.vars)
-            if vars_content != self.read_vars_contents:
-                with open(vars_path, "wb") as vars_file:
+            vars_content = _ENCODER.encode(self.vars)
+            # Only vars replaced by a plain dictionary need comparing to what was read
+            if tracked or vars_content != self.read_vars_contents:
+                temporary_path = vars_path + ".tmp"
+                with open(temporary_path, "wb") as vars_file:
                     vars_file.write(vars_content)
+                    vars_file.flush()
+                    os.fsync(vars_file.fileno())
+                os.replace(temporary_path, vars_path)
+                self.read_vars_contents = vars_content
+        if isinstance(self.vars, _DirtyDict):
+            self.vars.dirty = False
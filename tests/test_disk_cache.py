@@ -1,107 +1,290 @@
-import tempfile
+import os
 from pathlib import Path
-from tempfile import NamedTemporaryFile, TemporaryDirectory
 from typing import Iterator
 
+import msgspec
 import pytest
 
-from dqp.disk_cache import cached_iter, count_iter, first, load, save, scan, tee
+from dqp.disk_cache import (
+    cached_iter,
+    count_iter,
+    first,
+    load,
+    save,
+    scan,
+    scan_raw,
+    short_digest,
+    tee,
+)
 
 
-def test_should_hash_arguments() -> None:
+def test_should_hash_arguments(tmp_path: Path) -> None:
     """The cache default hash should include function arguments."""
 
-    with TemporaryDirectory() as temp_dir:
+    @cached_iter(base_path=tmp_path)
+    def repeater(count: int, value: str = "a") -> Iterator[tuple[int, str]]:
+        for idx in range(count):
+            yield [idx, value]
 
-        @cached_iter(base_path=temp_dir)
-        def repeater(count: int, value: str = "a") -> Iterator[tuple[int, str]]:
-            for idx in range(count):
-                yield [idx, value]
+    assert list(repeater(2, value="a")) == [[0, "a"], [1, "a"]]
+    assert list(repeater(2, value="a")) == [[0, "a"], [1, "a"]]
+    assert list(repeater(2, value="b")) == [[0, "b"], [1, "b"]]
+    assert list(repeater(2, value="a")) == [[0, "a"], [1, "a"]]
+    assert list(repeater(1, value="a")) == [[0, "a"]]
 
-        assert list(repeater(2, value="a")) == [[0, "a"], [1, "a"]]
-        assert list(repeater(2, value="a")) == [[0, "a"], [1, "a"]]
-        assert list(repeater(2, value="b")) == [[0, "b"], [1, "b"]]
-        assert list(repeater(2, value="a")) == [[0, "a"], [1, "a"]]
-        assert list(repeater(1, value="a")) == [[0, "a"]]
 
+def test_short_digest_should_ignore_keyword_order() -> None:
+    assert short_digest(1, a="x", b="y") == short_digest(1, b="y", a="x")
+    assert short_digest({"a": 1, "b": 2}) == short_digest({"b": 2, "a": 1})
+    assert short_digest(a="x") != short_digest(b="x")
 
-def test_should_accept_clear() -> None:
+
+def test_should_remember_storage_location(tmp_path: Path) -> None:
+    """The storage location should only be determined once for scalar arguments."""
+
+    requested = []
+
+    def storage_location(method_name, args, kwds) -> Path:
+        requested.append(args)
+        return tmp_path / f"{args!r}.msgpacks"
+
+    @cached_iter(get_storage_location=storage_location)
+    def repeater(value) -> Iterator[int]:
+        yield from value
+
+    assert list(repeater("ab")) == ["a", "b"]
+    assert list(repeater("ab")) == ["a", "b"]
+    assert requested == [("ab",)]
+    assert list(repeater([3])) == [3]
+    assert list(repeater([3])) == [3]
+    assert requested == [("ab",), ([3],), ([3],)], "Containers are not remembered"
+
+
+def test_should_hash_nested_argument_types(tmp_path: Path) -> None:
+    """Equal containers with differently typed values should not share a cache file."""
+
+    @cached_iter(base_path=tmp_path)
+    def repeater(value) -> Iterator[int]:
+        yield from value
+
+    for value in [(1, 2), (1.0, 2.0), (True, 2), (1, 2)]:
+        assert [type(v) for v in repeater(value)] == [type(v) for v in value]
+    assert len(list(tmp_path.iterdir())) == 3
+
+    @cached_iter(base_path=tmp_path)
+    def signed(value: float) -> Iterator[str]:
+        yield repr(value)
+
+    for value in [0.0, -0.0, 0.0, -0.0]:
+        assert list(signed(value)) == [repr(value)], "Equal floats can differ in sign"
+
+
+def test_should_bind_arguments_to_signature(tmp_path: Path) -> None:
+    """Equivalent calls should share the cache file."""
+
+    calls = 0
+
+    @cached_iter(base_path=tmp_path)
+    def repeater(count: int, value: str = "a", **extra) -> Iterator[str]:
+        nonlocal calls
+        calls += 1
+        for _ in range(count):
+            yield value
+
+    assert list(repeater(2)) == ["a", "a"]
+    assert list(repeater(2, value="a")) == ["a", "a"]
+    assert list(repeater(count=2)) == ["a", "a"]
+    assert list(repeater(1, extra=True)) == ["a"]
+    assert calls == 2
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_should_not_hash_unencodable_defaults(tmp_path: Path) -> None:
+    """Defaults hashed by their repr would differ between runs."""
+
+    calls = 0
+
+    def define_repeater():
+        # Every run creates a new default object
+        @cached_iter(base_path=tmp_path)
+        def repeater(count: int, key=lambda v: v, value: str = "a") -> Iterator[str]:
+            nonlocal calls
+            calls += 1
+            for _ in range(count):
+                yield key(value)
+
+        return repeater
+
+    assert list(define_repeater()(2)) == ["a", "a"]
+    assert list(define_repeater()(2)) == ["a", "a"]
+    assert list(define_repeater()(2, value="a")) == ["a", "a"]
+    assert calls == 1
+    assert len(list(tmp_path.iterdir())) == 1
+
+
+def test_storage_location_should_receive_call_arguments(tmp_path: Path) -> None:
+    """A custom storage location sees the arguments as passed by the caller."""
+
+    requested = []
+
+    def storage_location(method_name, args, kwds) -> Path:
+        requested.append((args, kwds))
+        return tmp_path / kwds["day"]
+
+    @cached_iter(get_storage_location=storage_location)
+    def per_day(day: str, count: int = 1) -> Iterator[str]:
+        yield from [day] * count
+
+    assert list(per_day(day="monday")) == ["monday"]
+    assert requested == [((), {"day": "monday"})]
+
+
+def test_should_not_check_known_cache_files(tmp_path: Path, monkeypatch) -> None:
+    """Once a cache file is written, it should not be looked up on disk again."""
+
+    @cached_iter(base_path=tmp_path)
+    def repeater() -> Iterator[int]:
+        yield from range(2)
+
+    assert list(repeater()) == [0, 1]
+
+    def exists(path: Path) -> bool:
+        raise AssertionError(f"Should not check {path}")
+
+    monkeypatch.setattr(Path, "exists", exists)
+    assert list(repeater()) == [0, 1]
+
+
+def test_should_recompute_removed_cache_files(tmp_path: Path) -> None:
+    """Cache files known to exist might be removed by others, like a temporary files cleaner."""
+
+    value = "a"
+
+    @cached_iter(base_path=tmp_path)
+    def repeater() -> Iterator[str]:
+        yield value
+
+    assert list(repeater()) == ["a"]
+    (cache_file,) = tmp_path.iterdir()
+    cache_file.unlink()
+    value = "b"
+    assert list(repeater()) == ["b"], "Should recompute the removed cache file"
+    assert cache_file.exists()
+    value = "c"
+    assert list(repeater()) == ["b"]
+
+
+def test_should_accept_clear(tmp_path: Path) -> None:
     """The cache default hash should include function arguments."""
 
-    with TemporaryDirectory() as temp_dir:
-        value = "a"
-
-        @cached_iter(base_path=temp_dir)
-        def repeater() -> Iterator[tuple[int, str]]:
-            nonlocal value
-            for idx in range(2):
-                yield [idx, value]
-
-        assert list(repeater()) == [[0, "a"], [1, "a"]]
-        value = "b"
-        assert list(repeater()) == [
-            [0, "a"],
-            [1, "a"],
-        ], "Before clear cache, we should still see the cache"
-        repeater.cache_clear()
-        assert list(repeater()) == [
-            [0, "b"],
-            [1, "b"],
-        ], "After clear cache, we should see the new value"
-        assert list(repeater()) == [[0, "b"], [1, "b"]]
-
-
-def test_should_not_accept_tuple() -> None:
+    value = "a"
+
+    @cached_iter(base_path=tmp_path)
+    def repeater() -> Iterator[tuple[int, str]]:
+        nonlocal value
+        for idx in range(2):
+            yield [idx, value]
+
+    assert list(repeater()) == [[0, "a"], [1, "a"]]
+    value = "b"
+    assert list(repeater()) == [
+        [0, "a"],
+        [1, "a"],
+    ], "Before clear cache, we should still see the cache"
+    repeater.cache_clear()
+    assert list(repeater()) == [
+        [0, "b"],
+        [1, "b"],
+    ], "After clear cache, we should see the new value"
+    assert list(repeater()) == [[0, "b"], [1, "b"]]
+
+
+def test_should_not_accept_tuple(tmp_path: Path) -> None:
     """Msg pack cannot serialize tuples"""
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        with pytest.raises(ValueError):
-            first(tee([(1, 2)], Path(temp_file.name)))
+    with pytest.raises(ValueError):
+        first(tee([(1, 2)], tmp_path / "cache"))
     with pytest.raises(ValueError):
         save("/won't/be/used", (1, 2))
 
 
-def test_should_maintain_order() -> None:
+def test_should_maintain_order(tmp_path: Path) -> None:
     """The cache default hash should include function arguments."""
 
-    with TemporaryDirectory() as temp_dir:
+    @cached_iter(base_path=tmp_path)
+    def test123() -> Iterator[str]:
+        for i in range(3):
+            yield i
+
+    assert list(test123()) == [0, 1, 2]
+    assert list(test123()) == [0, 1, 2]
+    assert list(test123()) == [0, 1, 2]
+
+
+def test_save_load(tmp_path: Path) -> None:
+    temp_file = str(tmp_path / "cache")
+    obj = [1, 2]
+    save(temp_file, obj)
+    assert load(temp_file) == obj
+
+
+def test_save_append(tmp_path: Path) -> None:
+    temp_path = tmp_path / "cache"
+    save(temp_path, 1, append=True)
+    save(temp_path, 2, append=True)
+    assert load(str(temp_path)) == 1
+    assert load(str(temp_path)) == 1
+    assert list(scan(str(temp_path))) == [1, 2]
+
+
+def test_tee(tmp_path: Path):
+    temp_file = str(tmp_path / "cache")
+    iterable = [1, 2, 3]
+    copy = []
+    for value in tee(iterable, temp_file):
+        copy.append(value)
+    assert copy == iterable, "Should see the same"
+    assert list(scan(temp_file)) == iterable, "Should have stored the same on disk"
 
-        @cached_iter(base_path=temp_dir)
-        def test123() -> Iterator[str]:
-            for i in range(3):
-                yield i
 
-        assert list(test123()) == [0, 1, 2]
-        assert list(test123()) == [0, 1, 2]
-        assert list(test123()) == [0, 1, 2]
+def test_scan_should_skip_incomplete_frame(tmp_path: Path):
+    """The last value might still be being written"""
+    temp_file = str(tmp_path / "cache")
+    save(temp_file, [1, 2], append=True)
+    save(temp_file, "abc", append=True)
+    with open(temp_file, "r+b") as disk_cache:
+        disk_cache.truncate(os.path.getsize(temp_file) - 1)
+    assert list(scan(temp_file)) == [[1, 2]]
 
 
-def test_save_load() -> None:
-    with NamedTemporaryFile() as temp_file:
-        obj = [1, 2]
-        save(temp_file.name, obj)
-        assert load(temp_file.name) == obj
+def test_scan_raw(tmp_path: Path):
+    source = tmp_path / "source"
+    values = [1, "a" * 300, {"b": [1, 2]}]
+    for value in values:
+        save(source, value, append=True)
+    target = tmp_path / "target"
+    assert list(tee(scan_raw(source), target)) == [
+        msgspec.Raw(msgspec.msgpack.encode(value)) for value in values
+    ]
+    assert list(scan(target)) == values, "Should copy the encoded values"
 
 
-def test_save_append() -> None:
-    with NamedTemporaryFile() as temp_file:
-        temp_path = Path(temp_file.name)
-        save(temp_path, 1, append=True)
-        save(temp_path, 2, append=True)
-        assert load(temp_file.name) == 1
-        assert load(temp_file.name) == 1
-        assert list(scan(temp_file.name)) == [1, 2]
+def test_scan_should_skip_values(tmp_path: Path):
+    temp_file = str(tmp_path / "cache")
+    for value in [1, "a" * 300, 3]:
+        save(temp_file, value, append=True)
+    assert list(scan(temp_file, skip=1)) == ["a" * 300, 3]
+    assert list(scan_raw(temp_file, skip=2)) == [msgspec.Raw(msgspec.msgpack.encode(3))]
+    assert list(scan(temp_file, skip=4)) == []
 
 
-def test_tee():
-    with NamedTemporaryFile() as temp_file:
-        iterable = [1, 2, 3]
-        copy = []
-        for value in tee(iterable, temp_file.name):
-            copy.append(value)
-        assert copy == iterable, "Should see the same"
-        assert (
-            list(scan(temp_file.name)) == iterable
-        ), "Should have stored the same on disk"
+def test_interleaved_scan(tmp_path: Path):
+    temp_file = str(tmp_path / "cache")
+    save(temp_file, 1, append=True)
+    save(temp_file, 2, append=True)
+    outer = scan(temp_file)
+    assert next(outer) == 1
+    assert list(scan(temp_file)) == [1, 2], "Readers should not block"
+    assert list(outer) == [2]
 
 
 def test_first():
@@ -113,4 +296,6 @@ def test_first():
 def test_count_iter():
     iterator = [1, 2, 3]
     assert count_iter(iterator) == 3
+    assert count_iter(iter(iterator)) == 3
+    assert count_iter([]) == 0
     assert count_iter(None) == 0
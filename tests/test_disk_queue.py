@@ -1,109 +1,293 @@
 import os
 import time
-from tempfile import TemporaryDirectory
+from pathlib import Path
 
+import msgspec
 import pytest
 
-from dqp.disk_queue import Project, Sink, Source
+from dqp.disk_cache import save
+from dqp.disk_queue import QUEUE_INDEX_SUFFIX, Project, Sink, Source
 
 
-def test_all_dict():
-    with TemporaryDirectory() as temp_dir:
-        with Sink(temp_dir) as temp_sink:
-            temp_sink.write_dict({"a": 1})
-            temp_sink.write_dict({"b": 2})
-            temp_sink.write_dict({"c": 3})
-        s = Source(temp_dir)
-        b_element = list(s.all_dict())[1]
-        assert b_element[2] == {"b": 2}, "Second element should be the 'b' element"
-        assert len(list(s.all_dict())) == 3, "Should have 3 elements on disk"
-        assert (
-            len(list(s.all_dict_from(b_element[0], 0))) == 3
-        ), "Should have 3 elements if we iterate from index 0"
-        assert b_element[1] == 1, "B should be the second element in the queue"
-        assert next(s.all_dict_from(b_element[0], b_element[1]))[2] == {"b": 2}
-        assert (
-            len(list(s.all_dict_from(b_element[0], 3))) == 0
-        ), "Should be empty after last element"
-
-
-def test_last_should_be_relative():
-    with TemporaryDirectory() as temp_dir:
-        with Sink(temp_dir) as temp_sink:
+def test_all_dict(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Sink(temp_dir) as temp_sink:
+        temp_sink.write_dict({"a": 1})
+        temp_sink.write_dict({"b": 2})
+        temp_sink.write_dict({"c": 3})
+    s = Source(temp_dir)
+    b_element = list(s.all_dict())[1]
+    assert b_element[2] == {"b": 2}, "Second element should be the 'b' element"
+    assert len(list(s.all_dict())) == 3, "Should have 3 elements on disk"
+    assert (
+        len(list(s.all_dict_from(b_element[0], 0))) == 3
+    ), "Should have 3 elements if we iterate from index 0"
+    assert b_element[1] == 1, "B should be the second element in the queue"
+    assert next(s.all_dict_from(b_element[0], b_element[1]))[2] == {"b": 2}
+    assert (
+        len(list(s.all_dict_from(b_element[0], 3))) == 0
+    ), "Should be empty after last element"
+    assert list(s.all_msgs()) == [{"a": 1}, {"b": 2}, {"c": 3}]
+    assert s.last == (b_element[0], 2), "Should track the last message"
+    s.last = (b_element[0], 1)
+    assert s.last == (b_element[0], 1)
+    s.last = None
+    assert s.last is None, "Should allow resetting the last message"
+
+
+def test_sink_should_write_in_batches(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Sink(temp_dir, write_buffer_size=10) as temp_sink:
+        temp_sink.write_dict({"a": 1})
+        assert os.path.getsize(temp_sink.output_path) == 0, "Should be buffered"
+        temp_sink.write_dict({"b": 22222})
+        assert os.path.getsize(temp_sink.output_path) > 0, "Should be written"
+        temp_sink.write_dict({"c": 3})
+        written_size = os.path.getsize(temp_sink.output_path)
+        temp_sink.flush()
+        assert os.path.getsize(temp_sink.output_path) > written_size
+    assert [msg for _, _, msg in Source(temp_dir)] == [
+        {"a": 1},
+        {"b": 22222},
+        {"c": 3},
+    ]
+
+
+def test_sink_should_keep_queue_intact_on_encode_error(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Sink(temp_dir) as temp_sink:
+        temp_sink.write_dict({"a": 1})
+        with pytest.raises(TypeError):
+            temp_sink.write_dict({"bad": object()})
+        temp_sink.write_dict({"c": 3})
+    s = Source(temp_dir)
+    assert [msg for _, _, msg in s.all_dict()] == [{"a": 1}, {"c": 3}]
+    assert s.count() == 2
+    (queue_filename,) = s.queue_filenames()
+    assert next(s.all_dict_from(queue_filename, 1))[2] == {"c": 3}
+
+
+def test_sink_close_should_be_idempotent(tmp_path: Path):
+    with Project(str(tmp_path)) as project:
+        with project.open_sink("hello") as temp_sink:
             temp_sink.write_dict({"a": 1})
-            time.sleep(1)  # Need next second in queue file name
-            temp_sink.rotate()
-            temp_sink.write_dict({"b": 2})
-            temp_sink.write_dict({"c": 3})
-
-        s = Source(temp_dir)
-        for fn in s.queue_filenames():
-            assert not fn.startswith("/"), "Must be relative"
-
-        assert len(list(s.all_dict())) == 3, "Must have entries"
-        assert s.last is not None and not s.last[0].startswith(
-            "/"
-        ), "Last path should be relative"
-        assert temp_dir not in s.last[0], "Should not know the temp_dir"
-        assert len([s.dicts_from(s.last[0])]), "Should be able to read last dicts"
-        with pytest.raises(ValueError):
-            s.unlink_to("does not exist")
-        s.unlink_to(s.last[0])
-
-        assert len(list(s.all_dict())) == 2, "Must have only the last block"
-
-
-def test_continue_source():
-    with TemporaryDirectory() as project_dir:
-        with Project(project_dir) as project:
-            s = project.open_sink("hello")
-            s.write_dict({"a": 1})
-            s.write_dict({"b": 1})
-            s.write_dict({"c": 1})
-            s.write_dict({"d": 1})
-
-        with Project(project_dir) as project:
-            s = project.continue_source("hello")
-            for filename, index, msg in s:
-                assert msg == {"a": 1}
-                break
-
-        with Project(project_dir) as project:
-            s = project.continue_source("hello")
-            for filename, index, msg in s:
-                assert msg == {"b": 1}
-                break
-
-
-def test_open_non_existing_source_should_raise():
+        with open(tmp_path / "other", "wb") as other_file:
+            temp_sink.close()
+            other_file.write(b"still open")
+    assert (tmp_path / "other").read_bytes() == b"still open"
+    assert Source(str(tmp_path / "queue" / "hello")).count() == 1
+
+
+def test_last_should_be_relative(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Sink(temp_dir) as temp_sink:
+        temp_sink.write_dict({"a": 1})
+        time.sleep(1)  # Need next second in queue file name
+        temp_sink.rotate()
+        temp_sink.write_dict({"b": 2})
+        temp_sink.write_dict({"c": 3})
+
+    s = Source(temp_dir)
+    for fn in s.queue_filenames():
+        assert not fn.startswith("/"), "Must be relative"
+
+    assert len(list(s.all_dict())) == 3, "Must have entries"
+    assert s.last is not None and not s.last[0].startswith(
+        "/"
+    ), "Last path should be relative"
+    assert temp_dir not in s.last[0], "Should not know the temp_dir"
+    assert len([s.dicts_from(s.last[0])]), "Should be able to read last dicts"
+    with pytest.raises(ValueError):
+        s.unlink_to("does not exist")
+    assert s.unlink_to(s.last[0]) == 1
+
+    assert len(list(s.all_dict())) == 2, "Must have only the last block"
+    last_name = os.path.basename(s.last[0])
+    assert sorted(name for _, _, names in os.walk(temp_dir) for name in names) == [
+        last_name,
+        last_name + QUEUE_INDEX_SUFFIX,
+    ], "Should unlink the index files"
+
+
+def test_all_dict_from_should_only_skip_in_first_file(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Sink(temp_dir) as temp_sink:
+        temp_sink.write_dict({"a": 1})
+        temp_sink.write_dict({"b": 2})
+        time.sleep(1)  # Need next second in queue file name
+        temp_sink.rotate()
+        temp_sink.write_dict({"c": 3})
+
+    s = Source(temp_dir)
+    first_filename = next(s.queue_filenames())
+    assert [msg for _, _, msg in s.all_dict_from(first_filename, 2)] == [{"c": 3}]
+
+
+def test_all_dict_from_should_use_index_file(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Sink(temp_dir, write_buffer_size=10) as temp_sink:
+        for value in range(5):
+            temp_sink.write_dict({"v": value})
+
+    s = Source(temp_dir)
+    (queue_filename,) = s.queue_filenames()
+    index_path = os.path.join(temp_dir, queue_filename + QUEUE_INDEX_SUFFIX)
+    assert os.path.getsize(index_path) == 5 * 8, "Should index every message"
+    assert [msg for _, _, msg in s.all_dict_from(queue_filename, 3)] == [
+        {"v": 3},
+        {"v": 4},
+    ]
+    assert [idx for _, idx, _ in s.all_dict_from(queue_filename, -1)] == [
+        0,
+        1,
+        2,
+        3,
+        4,
+    ], "Negative indexes should start at the first message"
+    # Incomplete index, only the first two messages are known
+    with open(index_path, "r+b") as index_file:
+        index_file.truncate(2 * 8 + 3)
+    assert [idx for _, idx, _ in s.all_dict_from(queue_filename, 3)] == [3, 4]
+    os.unlink(index_path)
+    assert [idx for _, idx, _ in s.all_dict_from(queue_filename, 3)] == [3, 4]
+
+
+def test_count(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Sink(temp_dir) as temp_sink:
+        for value in range(3):
+            temp_sink.write_dict({"v": value})
+        time.sleep(1)  # Need next second in queue file name
+        temp_sink.rotate()
+        temp_sink.write_dict({"v": 3})
+        temp_sink.flush()
+        assert Source(temp_dir).count() == 4, "Should count the file being written"
+    s = Source(temp_dir)
+    assert s.count() == 4
+    first_filename = next(s.queue_filenames())
+    os.unlink(os.path.join(temp_dir, first_filename + QUEUE_INDEX_SUFFIX))
+    assert s.count() == 4, "Should count files without an index"
+    assert s.last is None, "Counting should not read messages"
+
+
+def test_source_should_reject_unframed_queue_files(tmp_path: Path):
+    """Queue files written before length prefixed frames should not read as empty"""
+    temp_dir = str(tmp_path)
+    with open(os.path.join(temp_dir, "000000_abcdef"), "wb") as queue_file:
+        for value in [{"a": 1}, {"b": 2}]:
+            queue_file.write(msgspec.msgpack.encode(value))
+    s = Source(temp_dir)
+    with pytest.raises(ValueError):
+        list(s.all_dict())
+    with pytest.raises(ValueError):
+        s.count()
+    assert s.unlink_to("000000") == 0
+    with open(os.path.join(temp_dir, "000000_abcdef"), "wb") as queue_file:
+        queue_file.write(msgspec.msgpack.encode({}))
+    with pytest.raises(ValueError):
+        s.count()
+
+
+def test_source_should_only_read_dictionaries(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    save(os.path.join(temp_dir, "000000"), [1, 2])
+    with pytest.raises(msgspec.ValidationError):
+        list(Source(temp_dir).all_dict())
+
+
+def test_queue_filenames_should_be_sorted(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    for queue_filename in [
+        "2024/01/10/000000",
+        "2023/12/31/235959",
+        "2024/01/02/120000",
+    ]:
+        queue_path = os.path.join(temp_dir, queue_filename)
+        os.makedirs(os.path.dirname(queue_path), exist_ok=True)
+        open(queue_path, "wb").close()
+    open(os.path.join(temp_dir, "2024", ".000000.swp"), "wb").close()
+    os.makedirs(os.path.join(temp_dir, ".hidden"))
+    open(os.path.join(temp_dir, ".hidden", "000000"), "wb").close()
+    source = Source(temp_dir)
+    assert list(source.queue_filenames()) == [
+        os.path.join("2023", "12", "31", "235959"),
+        os.path.join("2024", "01", "02", "120000"),
+        os.path.join("2024", "01", "10", "000000"),
+    ]
+    assert list(source.queue_filenames(start=os.path.join("2024", "01"))) == [
+        os.path.join("2024", "01", "02", "120000"),
+        os.path.join("2024", "01", "10", "000000"),
+    ]
+    assert list(source.queue_filenames(start=os.path.join("2024", "01", "05"))) == [
+        os.path.join("2024", "01", "10", "000000"),
+    ]
+
+
+def test_continue_source(tmp_path: Path):
+    project_dir = str(tmp_path)
+    with Project(project_dir) as project:
+        s = project.open_sink("hello")
+        s.write_dict({"a": 1})
+        s.write_dict({"b": 1})
+        s.write_dict({"c": 1})
+        s.write_dict({"d": 1})
+
+    with Project(project_dir) as project:
+        s = project.continue_source("hello")
+        for filename, index, msg in s:
+            assert msg == {"a": 1}
+            break
+
+    with Project(project_dir) as project:
+        s = project.continue_source("hello")
+        for filename, index, msg in s:
+            assert msg == {"b": 1}
+            break
+
+
+def test_open_non_existing_source_should_raise(tmp_path: Path):
     with pytest.raises(ValueError):
-        with TemporaryDirectory() as project_dir:
-            with Project(project_dir) as project:
-                project.open_source("asfd")
-
-
-def test_moving_project_dir_should_work():
-    with TemporaryDirectory() as written_to:
-        with TemporaryDirectory() as read_from:
-            with Project(written_to) as project:
-                temp_sink = project.open_sink("hello")
-                temp_sink.write_dict({"a": 1})
-                temp_sink.write_dict({"b": 1})
-                time.sleep(1)  # Need next second in queue file name
-                temp_sink.rotate()
-                temp_sink.write_dict({"b": 2})
-                temp_sink.write_dict({"c": 3})
-
-            os.rename(written_to, read_from + "/project")
-
-            with Project(read_from + "/project") as project:
-                source = project.continue_source("hello")
-                assert sum([1 for e in source]) == 4
-                assert source.unlink_to() == 1
-
-            with Project(read_from + "/project") as project:
-                source = project.continue_source("hello")
-                assert sum([1 for e in source]) == 0
-                assert (
-                    sum([1 for e in source.all_dict()]) == 2
-                ), "Only last queue file is left"
+        with Project(str(tmp_path)) as project:
+            project.open_source("asfd")
+
+
+def test_moving_project_dir_should_work(tmp_path_factory: pytest.TempPathFactory):
+    written_to = str(tmp_path_factory.mktemp("written_to"))
+    read_from = str(tmp_path_factory.mktemp("read_from"))
+    with Project(written_to) as project:
+        temp_sink = project.open_sink("hello")
+        temp_sink.write_dict({"a": 1})
+        temp_sink.write_dict({"b": 1})
+        time.sleep(1)  # Need next second in queue file name
+        temp_sink.rotate()
+        temp_sink.write_dict({"b": 2})
+        temp_sink.write_dict({"c": 3})
+
+    os.rename(written_to, read_from + "/project")
+
+    with Project(read_from + "/project") as project:
+        source = project.continue_source("hello")
+        assert sum([1 for e in source]) == 4
+        assert source.unlink_to() == 1
+
+    with Project(read_from + "/project") as project:
+        source = project.continue_source("hello")
+        assert sum([1 for e in source]) == 0
+        assert sum([1 for e in source.all_dict()]) == 2, "Only last queue file is left"
+
+
+def test_copied_project_should_continue(tmp_path: Path):
+    project_dir = str(tmp_path / "project")
+    with Project(project_dir) as project:
+        s = project.open_sink("hello")
+        s.write_dict({"a": 1})
+        s.write_dict({"b": 1})
+    with Project(project_dir) as project:
+        s = project.continue_source("hello")
+        assert next(iter(s))[2] == {"a": 1}
+    with Project(project_dir) as project:
+        project.copy_to(str(tmp_path / "copy"))
+
+    with Project(str(tmp_path / "copy")) as project:
+        s = project.continue_source("hello")
+        assert [msg for _, _, msg in s] == [{"b": 1}]
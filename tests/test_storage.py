@@ -1,19 +1,48 @@
 import os
-from tempfile import TemporaryDirectory
+from pathlib import Path
 
 from dqp.storage import VARS_FILENAME, Folder
 
 
-def test_should_not_write_empty_vars_files():
-    with TemporaryDirectory() as temp_dir:
-        with Folder(temp_dir) as _:
-            assert not os.path.exists(temp_dir + "/" + VARS_FILENAME)
+def test_should_not_write_empty_vars_files(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Folder(temp_dir) as _:
         assert not os.path.exists(temp_dir + "/" + VARS_FILENAME)
+    assert not os.path.exists(temp_dir + "/" + VARS_FILENAME)
 
 
-def test_should_only_write_vars_if_changed():
-    with TemporaryDirectory() as temp_dir:
-        with Folder(temp_dir) as f:
-            f.vars["a"] = "b"
-            assert not os.path.exists(temp_dir + "/" + VARS_FILENAME)
-        assert os.path.exists(temp_dir + "/" + VARS_FILENAME)
+def test_should_only_write_vars_if_changed(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Folder(temp_dir) as f:
+        f.vars["a"] = "b"
+        assert not os.path.exists(temp_dir + "/" + VARS_FILENAME)
+    assert os.path.exists(temp_dir + "/" + VARS_FILENAME)
+
+
+def test_should_write_changed_vars(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Folder(temp_dir) as f:
+        f.vars["a"] = "b"
+    with Folder(temp_dir) as f:
+        assert f.vars == {"a": "b"}
+        f.vars.update(c="d")
+    with Folder(temp_dir) as f:
+        assert f.vars == {"a": "b", "c": "d"}
+        del f.vars["a"]
+    with Folder(temp_dir) as f:
+        assert f.vars == {"c": "d"}
+    assert os.listdir(temp_dir) == [VARS_FILENAME], "Should not leave files behind"
+
+
+def test_should_not_write_vars_set_to_the_same_value(tmp_path: Path):
+    temp_dir = str(tmp_path)
+    with Folder(temp_dir) as f:
+        f.vars["a"] = "b"
+    written = os.stat(os.path.join(temp_dir, VARS_FILENAME))
+    with Folder(temp_dir) as f:
+        f.vars["a"] = "b"
+        assert not f.vars.dirty, "Same value should not be a change"
+    assert os.stat(os.path.join(temp_dir, VARS_FILENAME)).st_ino == written.st_ino
+    with Folder(temp_dir) as f:
+        f.vars["a"] = "c"
+        assert f.vars.dirty